@@ -1,21 +1,67 @@
 #!/usr/bin/env python3
 
 import os
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import pillow_heif
 import numpy as np
+import tifffile
 from pathlib import Path
-import json
 import base64
+import msgpack
+import orjson
+from heif_utils import as_array
 
-def extract_all_images(input_path, output_dir=None):
+# Classic TIFF offsets are 32-bit, leave room for tags and strip tables
+_BIGTIFF_THRESHOLD = 2**32 - 2**25
+
+# Info values copied verbatim into the metadata file
+_SCALAR_TYPES = (str, int, float, bool, type(None), bytes)
+# Info blobs that are also surfaced at the top level of the metadata
+_BLOB_KEYS = ('icc_profile', 'exif', 'xmp')
+
+def _save_tiff(path, arr):
+    """Write a pixel array as an uncompressed TIFF."""
+    photometric = 'rgb' if arr.ndim == 3 else 'minisblack'
+    # Tag RGBA alpha as unassociated, like PIL did
+    extrasamples = ('unassalpha',) if arr.ndim == 3 and arr.shape[2] == 4 else None
+    tifffile.imwrite(
+        path,
+        arr,
+        photometric=photometric,
+        extrasamples=extrasamples,
+        compression=None,
+        bigtiff=arr.nbytes >= _BIGTIFF_THRESHOLD,
+    )
+
+def _extract_aux(heif_file, aux_type, aux_id, output_dir, stem):
+    """Decode one auxiliary image and save it as TIFF, returning (name, path) or None."""
+    try:
+        aux = as_array(heif_file.get_aux_image(aux_id))
+        
+        # Create a sanitized filename from the aux type
+        aux_type_name = aux_type.split(':')[-1]
+        aux_path = output_dir / f"{stem}_{aux_type_name}_{aux_id}.tiff"
+        _save_tiff(aux_path, aux)
+        return f"{aux_type_name}_{aux_id}", str(aux_path)
+    except Exception as e:
+        print(f"Warning: Could not extract auxiliary image {aux_id} of type {aux_type}: {str(e)}")
+        return None
+
+def _json_default(value):
+    """Encode bytes as base64 so they survive JSON serialization."""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('utf-8')
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def extract_all_images(input_path, output_dir=None, metadata_format='msgpack'):
     """
     Extract all images from a HEIC file including base image, gain map, depth map, and all auxiliary images.
-    Also dumps all metadata into a JSON file.
+    Also dumps all metadata into a MessagePack (or JSON) file.
     
     Args:
         input_path (str): Path to input HDR image (HEIC or JPEG)
         output_dir (str, optional): Directory for output files. If None, will use input file's directory.
+        metadata_format (str, optional): 'msgpack' to store binary blobs natively, or 'json' to base64-encode them.
     """
     input_path = Path(input_path)
     
@@ -28,59 +74,39 @@ def extract_all_images(input_path, output_dir=None):
     
     # Read HEIC file
     heif_file = pillow_heif.read_heif(str(input_path))
+    info = heif_file.info
     
     # Dictionary to store all extracted images and their paths
     extracted_images = {}
     
     # Get primary image
-    base_image = Image.frombytes(
-        heif_file.mode,
-        heif_file.size,
-        heif_file.data,
-        "raw",
-        heif_file.mode,
-        heif_file.stride,
-    )
+    base = as_array(heif_file)
     base_path = output_dir / f"{input_path.stem}_base.tiff"
-    base_image.save(base_path, format='TIFF')
+    _save_tiff(base_path, base)
     extracted_images['base'] = str(base_path)
     
-    # Extract all auxiliary images
-    if 'aux' in heif_file.info:
-        for aux_type, aux_ids in heif_file.info['aux'].items():
-            for aux_id in aux_ids:
-                try:
-                    aux_image = heif_file.get_aux_image(aux_id)
-                    aux_pil = Image.frombytes(
-                        aux_image.mode,
-                        aux_image.size,
-                        aux_image.data,
-                        "raw",
-                        aux_image.mode,
-                        aux_image.stride,
-                    )
-                    
-                    # Create a sanitized filename from the aux type
-                    aux_type_name = aux_type.split(':')[-1]
-                    aux_path = output_dir / f"{input_path.stem}_{aux_type_name}_{aux_id}.tiff"
-                    aux_pil.save(aux_path, format='TIFF')
-                    extracted_images[f"{aux_type_name}_{aux_id}"] = str(aux_path)
-                except Exception as e:
-                    print(f"Warning: Could not extract auxiliary image {aux_id} of type {aux_type}: {str(e)}")
+    # Extract all auxiliary images, decoding and writing them in parallel
+    if 'aux' in info:
+        tasks = [
+            (aux_type, aux_id)
+            for aux_type, aux_ids in info['aux'].items()
+            for aux_id in aux_ids
+        ]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(
+                lambda task: _extract_aux(heif_file, *task, output_dir, input_path.stem), tasks
+            ))
+        for result in results:
+            if result is not None:
+                name, aux_path = result
+                extracted_images[name] = aux_path
     
     # Extract depth images if available
-    if 'depth_images' in heif_file.info and heif_file.info['depth_images']:
-        for i, depth_image in enumerate(heif_file.info['depth_images']):
-            depth_pil = Image.frombytes(
-                depth_image.mode,
-                depth_image.size,
-                depth_image.data,
-                "raw",
-                depth_image.mode,
-                depth_image.stride,
-            )
+    if info.get('depth_images'):
+        for i, depth_image in enumerate(info['depth_images']):
+            depth = as_array(depth_image)
             depth_path = output_dir / f"{input_path.stem}_depth_{i}.tiff"
-            depth_pil.save(depth_path, format='TIFF')
+            _save_tiff(depth_path, depth)
             extracted_images[f"depth_{i}"] = str(depth_path)
     
     # Prepare metadata
@@ -98,35 +124,26 @@ def extract_all_images(input_path, output_dir=None):
         }
     }
     
-    # Copy all info
-    for key, value in heif_file.info.items():
-        if isinstance(value, (str, int, float, bool, type(None))):
+    # Copy all info in a single pass, picking up ICC profile, EXIF and XMP on the way
+    # Bytes are kept raw, msgpack stores them natively
+    for key, value in info.items():
+        if isinstance(value, _SCALAR_TYPES):
             metadata['info'][key] = value
-        elif isinstance(value, bytes):
-            # Convert bytes to base64 for JSON serialization
-            metadata['info'][key] = base64.b64encode(value).decode('utf-8')
         elif isinstance(value, dict):
-            metadata['info'][key] = {
-                k: base64.b64encode(v).decode('utf-8') if isinstance(v, bytes) else v
-                for k, v in value.items()
-            }
-    
-    # Handle ICC profile
-    if 'icc_profile' in heif_file.info:
-        metadata['icc_profile'] = base64.b64encode(heif_file.info['icc_profile']).decode('utf-8')
-    
-    # Handle EXIF
-    if 'exif' in heif_file.info:
-        metadata['exif'] = base64.b64encode(heif_file.info['exif']).decode('utf-8')
-    
-    # Handle XMP
-    if 'xmp' in heif_file.info:
-        metadata['xmp'] = base64.b64encode(heif_file.info['xmp']).decode('utf-8')
+            metadata['info'][key] = dict(value)
+        if key in _BLOB_KEYS:
+            metadata[key] = value
     
     # Save metadata to file
-    metadata_path = output_dir / f"{input_path.stem}_metadata.json"
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    if metadata_format == 'json':
+        metadata_path = output_dir / f"{input_path.stem}_metadata.json"
+        # Compact output, the metadata is meant for machines and orjson already emits bytes
+        with open(metadata_path, 'wb') as f:
+            f.write(orjson.dumps(metadata, default=_json_default, option=orjson.OPT_APPEND_NEWLINE))
+    else:
+        metadata_path = output_dir / f"{input_path.stem}_metadata.msgpack"
+        with open(metadata_path, 'wb') as f:
+            msgpack.pack(metadata, f, use_bin_type=True)
     
     # Return paths and metadata
     result = {
@@ -142,11 +159,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract all images and metadata from HEIC files')
     parser.add_argument('input', help='Input HEIC image path')
     parser.add_argument('--output-dir', help='Output directory for extracted images')
+    parser.add_argument('--metadata-format', choices=['msgpack', 'json'], default='msgpack',
+                        help='Metadata file format (default: msgpack)')
     
     args = parser.parse_args()
     
     try:
-        result = extract_all_images(args.input, args.output_dir)
+        result = extract_all_images(args.input, args.output_dir, args.metadata_format)
         print("\nExtracted images:")
         for name, path in result['extracted_images'].items():
             print(f"{name}: {path}")
@@ -4,40 +4,124 @@ import os
 import sys
 import tempfile
 import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
 import pillow_heif
 import numpy as np
-import subprocess
 import json
+import OpenImageIO as oiio
+from OpenImageIO import ImageBufAlgo
+from heif_utils import as_array
+
+# numba is optional, without it the gain map is applied with plain numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Size OIIO's worker pool, used by EXR writes and ImageBufAlgo, to the core count
+oiio.attribute("threads", max(1, os.cpu_count() or 1))
+
+OCIO_CONFIG = 'studio-config-v1.0.0_aces-v1.3_ocio-v2.1.ocio'
+
+# Matrices from OCIO_CONFIG: ACES2065-1 to Linear P3-D65, and the ACEScg_to_ACES2065-1 builtin
+_AP0_TO_P3D65 = np.array([
+    [2.02490528596679, -0.689069761034766, -0.335835524932019],
+    [-0.183597032256178, 1.28950620775902, -0.105909175502841],
+    [0.00905856112234766, -0.0592796840575522, 1.0502211229352],
+])
+_AP1_TO_AP0 = np.array([
+    [0.6954522414, 0.1406786965, 0.1638690622],
+    [0.0447945634, 0.8596711185, 0.0955343182],
+    [-0.0055258826, 0.0040252103, 1.0015006723],
+])
+# Linear P3-D65 -> ACES2065-1 -> ACEScg folded into one matrix
+_P3D65_TO_ACESCG = np.linalg.inv(_AP0_TO_P3D65 @ _AP1_TO_AP0).astype(np.float32)
+
+def _srgb_to_linear_lut():
+    """Tabulate the config's sRGB curve (gamma 2.4, offset 0.055 moncurve) for 8-bit code values."""
+    gamma, offset = 2.4, 0.055
+    x = np.arange(256) / 255.0
+    break_point = offset / (gamma - 1.0)
+    slope = ((break_point + offset) / (1.0 + offset)) ** gamma / break_point
+    linear = np.where(x > break_point, ((x + offset) / (1.0 + offset)) ** gamma, x * slope)
+    return linear.astype(np.float32)
+
+_SRGB_TO_LINEAR = _srgb_to_linear_lut()
+
+def _checked(buf):
+    """Raise if an OIIO operation left an error on its result buffer."""
+    if buf.has_error:
+        raise RuntimeError(buf.geterror())
+    return buf
+
+def _to_imagebuf(arr, channelnames):
+    """Load a decoded pixel array into a float ImageBuf with the given channel names."""
+    height, width = arr.shape[:2]
+    spec = oiio.ImageSpec(width, height, len(channelnames), oiio.FLOAT)
+    spec.channelnames = channelnames
+    buf = oiio.ImageBuf(spec)
+    buf.set_pixels(oiio.ROI.All, arr.reshape(height, width, len(channelnames)))
+    return _checked(buf)
 
-def extract_heic(input_path, output_dir):
-    """Extract all images from HEIC file to TIFFs."""
+def _resize_to(buf, width, height):
+    """Resize an image to width x height, keeping all of its channels."""
+    roi = oiio.ROI(0, width, 0, height, 0, 1, 0, buf.nchannels)
+    return _checked(ImageBufAlgo.resize(buf, roi=roi))
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _apply_gain_map_rows(sdr, gainmap, headroom_minus_1):
+        """Fused gain map kernel, one row per worker thread."""
+        out = np.empty_like(sdr)
+        for y in prange(sdr.shape[0]):
+            for x in range(sdr.shape[1]):
+                scale = gainmap[y, x, 0] * headroom_minus_1 + np.float32(1.0)
+                for c in range(sdr.shape[2]):
+                    out[y, x, c] = sdr[y, x, c] * scale
+        return out
+else:
+    _apply_gain_map_rows = None
+
+def _apply_gain_map(sdr, gainmap, headroom):
+    """Return sdr * (gainmap * (headroom - 1) + 1), broadcasting the Y gain map over RGB."""
+    if _apply_gain_map_rows is not None:
+        return _apply_gain_map_rows(sdr, gainmap, np.float32(headroom - 1.0))
+    scale = gainmap * np.float32(headroom - 1.0)
+    scale += 1.0
+    return sdr * scale
+
+def _extract_matte(heif_file, aux_type, aux_id):
+    """Decode one matte, returning (layer name, pixels) or None."""
+    try:
+        matte = as_array(heif_file.get_aux_image(aux_id))
+        aux_type_name = aux_type.split(':')[-1]
+        # Clean up the matte name to be more Nuke-friendly
+        clean_name = f"{aux_type_name}_{aux_id}".replace("matte_", "")
+        print(f"Extracted matte {aux_id} as {clean_name}")
+        return clean_name, matte
+    except Exception as e:
+        print(f"Warning: Could not extract matte {aux_id}: {str(e)}")
+        return None
+
+def extract_heic(input_path):
+    """Extract all images from HEIC file as numpy arrays."""
     print(f"\nExtracting images from {input_path}...")
     
     heif_file = pillow_heif.read_heif(str(input_path))
     print(f"HEIC info: {heif_file.info}")
     
-    # Initialize paths
-    base_path = None
-    gain_map_path = None
-    depth_path = None
-    matte_paths = []
+    # Initialize images
+    gain_map = None
+    depth = None
+    mattes = []
     headroom = None
     
     # Extract base image
     print("\nExtracting base image...")
-    base_image = Image.frombytes(
-        heif_file.mode,
-        heif_file.size,
-        heif_file.data,
-        "raw",
-        heif_file.mode,
-        heif_file.stride,
-    )
-    base_path = output_dir / "input_base.tiff"
-    base_image.save(base_path, format='TIFF')
-    print(f"Saved base image to {base_path}")
+    base = as_array(heif_file)
+    print(f"Extracted base image {base.shape}")
     
     # Extract gain map
     print("\nLooking for gain map...")
@@ -48,17 +132,8 @@ def extract_heic(input_path, output_dir):
                 aux_id = heif_file.info['aux']['urn:com:apple:photo:2020:aux:hdrgainmap'][0]
                 print(f"Found gain map aux ID: {aux_id}")
                 aux_image = heif_file.get_aux_image(aux_id)
-                gain_map = Image.frombytes(
-                    aux_image.mode,
-                    aux_image.size,
-                    aux_image.data,
-                    "raw",
-                    aux_image.mode,
-                    aux_image.stride,
-                )
-                gain_map_path = output_dir / "input_hdrgainmap_50.tiff"
-                gain_map.save(gain_map_path, format='TIFF')
-                print(f"Saved gain map to {gain_map_path}")
+                gain_map = as_array(aux_image)
+                print(f"Extracted gain map {gain_map.shape}")
             except Exception as e:
                 print(f"Warning: Could not extract gain map: {str(e)}")
         else:
@@ -71,17 +146,8 @@ def extract_heic(input_path, output_dir):
     if 'depth_images' in heif_file.info and heif_file.info['depth_images']:
         try:
             depth_image = heif_file.info['depth_images'][0]
-            depth_map = Image.frombytes(
-                depth_image.mode,
-                depth_image.size,
-                depth_image.data,
-                "raw",
-                depth_image.mode,
-                depth_image.stride,
-            )
-            depth_path = output_dir / "input_depth_0.tiff"
-            depth_map.save(depth_path, format='TIFF')
-            print(f"Saved depth map to {depth_path}")
+            depth = as_array(depth_image)
+            print(f"Extracted depth map {depth.shape}")
         except Exception as e:
             print(f"Warning: Could not extract depth map: {str(e)}")
     else:
@@ -90,207 +156,135 @@ def extract_heic(input_path, output_dir):
     # Extract mattes
     print("\nLooking for mattes...")
     if 'aux' in heif_file.info:
+        tasks = []
         for aux_type, aux_ids in heif_file.info['aux'].items():
             if 'matte' in aux_type.lower():
                 print(f"Found matte type: {aux_type}")
-                for aux_id in aux_ids:
-                    try:
-                        aux_image = heif_file.get_aux_image(aux_id)
-                        aux_pil = Image.frombytes(
-                            aux_image.mode,
-                            aux_image.size,
-                            aux_image.data,
-                            "raw",
-                            aux_image.mode,
-                            aux_image.stride,
-                        )
-                        aux_type_name = aux_type.split(':')[-1]
-                        aux_path = output_dir / f"input_{aux_type_name}_{aux_id}.tiff"
-                        aux_pil.save(aux_path, format='TIFF')
-                        matte_paths.append(aux_path)
-                        print(f"Saved matte {aux_id} to {aux_path}")
-                    except Exception as e:
-                        print(f"Warning: Could not extract matte {aux_id}: {str(e)}")
+                tasks.extend((aux_type, aux_id) for aux_id in aux_ids)
+        # Mattes are independent, decode them in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(lambda task: _extract_matte(heif_file, *task), tasks))
+        mattes = [result for result in results if result is not None]
     else:
         print("No mattes found")
     
-    # Get HDR headroom
+    # Get HDR headroom. pillow_heif does not normally expose it: HDRGainMapHeadroom
+    # is an exiftool Composite tag derived from the Apple maker notes, so fall back to
+    # exiftool, and only when there is a gain map that needs it
     if 'HDRGainMapHeadroom' in heif_file.info:
         headroom = heif_file.info['HDRGainMapHeadroom']
         print(f"\nFound HDR headroom: {headroom}")
+    elif gain_map is not None:
+        headroom = float(subprocess.check_output(['exiftool', '-HDRGainMapHeadroom', '-b', str(input_path)]).decode())
+        print(f"\nRead HDR headroom with exiftool: {headroom}")
     else:
-        print("\nNo HDR headroom found in HEIC info")
+        print("\nNo gain map, HDR headroom not needed")
     
-    return base_path, gain_map_path, depth_path, matte_paths, headroom
+    return base, gain_map, depth, mattes, headroom
 
-def merge_to_exr(input_dir, original_heic, output_path):
-    """Merge extracted TIFFs into a multilayer EXR."""
+def merge_to_exr(input_dir, base_image, gain_map_image, depth_image, matte_images, headroom, output_path):
+    """Merge extracted image arrays into a multilayer EXR."""
     print("\nMerging to EXR...")
     
     # Get dimensions from base image
-    print("Getting image dimensions...")
-    base_info = subprocess.check_output(['oiiotool', '--info', str(input_dir / "input_base.tiff")]).decode()
-    print(f"Base image info: {base_info}")
-    width = int(base_info.split()[2])
-    height = int(base_info.split()[4].rstrip(','))
+    height, width = base_image.shape[:2]
     print(f"Image dimensions: {width}x{height}")
 
     # Process base image (RGB) - Convert from sRGB curve through Linear P3 to ACEScg
     print("\nProcessing base image...")
-    subprocess.run([
-        'oiiotool', str(input_dir / "input_base.tiff"),
-        '--ch', 'R,G,B',
-        '--chnames', 'sdr.R,sdr.G,sdr.B',
-        '--colorconfig', 'studio-config-v1.0.0_aces-v1.3_ocio-v2.1.ocio',
-        '--colorconvert', 'sRGB - Texture', 'Linear Rec.709 (sRGB)',
-        '--colorconvert', 'Linear P3-D65', 'ACES - ACEScg',
-        '-o', str(input_dir / "base.exr")
-    ], check=True)
+    # The sRGB curve is a table lookup on the 8-bit codes, the primaries change one matrix multiply
+    linear = _SRGB_TO_LINEAR[base_image[..., :3]]
+    sdr = (linear.reshape(-1, 3) @ _P3D65_TO_ACESCG.T).reshape(height, width, 3)
+    base = _to_imagebuf(sdr, ('sdr.R', 'sdr.G', 'sdr.B'))
     print("Base image processed")
 
     # Process gain map if it exists
-    gain_map_path = input_dir / "input_hdrgainmap_50.tiff"
-    if gain_map_path.exists():
+    gainmap = None
+    if gain_map_image is not None:
         print("\nProcessing gain map...")
         # Process gain map (Y) - Convert from Rec709 curve to Linear
-        subprocess.run([
-            'oiiotool', str(gain_map_path),
-            '--ch', 'Y',
-            '--chnames', 'gainmap.Y',
-            '--resize', f"{width}x{height}",
-            '--colorconfig', 'studio-config-v1.0.0_aces-v1.3_ocio-v2.1.ocio',
-            '--ocionamedtransform', 'Rec.709 - Curve',
-            '-o', str(input_dir / "gainmap.exr")
-        ], check=True)
+        gainmap = _to_imagebuf(gain_map_image, ('gainmap.Y',))
+        gainmap = _resize_to(gainmap, width, height)
+        gainmap = _checked(ImageBufAlgo.ocionamedtransform(
+            gainmap, 'Rec.709 - Curve', colorconfig=OCIO_CONFIG
+        ))
         print("Gain map processed")
 
-        # Create 3-channel gainmap by duplicating Y to RGB
-        subprocess.run([
-            'oiiotool', str(input_dir / "gainmap.exr"),
-            '--ch', 'gainmap.Y,gainmap.Y,gainmap.Y',
-            '--chnames', 'gainmap.R,gainmap.G,gainmap.B',
-            '-o', str(input_dir / "gainmap_rgb.exr")
-        ], check=True)
-        print("Gain map converted to RGB")
-
-        # Calculate HDR: first multiply gainmap by (headroom - 1.0)
-        headroom = float(subprocess.check_output(['exiftool', '-HDRGainMapHeadroom', '-b', str(original_heic)]).decode())
+        # Calculate HDR: base * (gainmap * (headroom - 1.0) + 1.0) in one pass over the pixels
+        if headroom is None:
+            raise ValueError("Gain map found but no HDR headroom was extracted")
+        headroom = float(headroom)
         print(f"Using HDR headroom: {headroom}")
-        subprocess.run([
-            'oiiotool', str(input_dir / "gainmap_rgb.exr"),
-            '--mulc', str(headroom - 1.0),
-            '--addc', '1.0',
-            '-o', str(input_dir / "gainmap_scaled.exr")
-        ], check=True)
-        print("Gain map scaled")
-
-        # Then multiply base image by scaled gainmap
-        subprocess.run([
-            'oiiotool', str(input_dir / "base.exr"),
-            str(input_dir / "gainmap_scaled.exr"),
-            '--mul',
-            '--chnames', 'R,G,B',
-            '-o', str(input_dir / "hdr_base.exr")
-        ], check=True)
+        hdr = _apply_gain_map(sdr, gainmap.get_pixels(oiio.FLOAT), headroom)
+        hdr_base = _to_imagebuf(hdr, ('R', 'G', 'B'))
         print("HDR base created")
+
+        # Create 3-channel gainmap layer by duplicating Y to RGB
+        gainmap = _checked(ImageBufAlgo.channels(
+            gainmap, (0, 0, 0), ('gainmap.R', 'gainmap.G', 'gainmap.B')
+        ))
+        print("Gain map converted to RGB")
     else:
         print("\nNo gain map found, using base image as HDR base")
-        shutil.copy(str(input_dir / "base.exr"), str(input_dir / "hdr_base.exr"))
+        hdr_base = _to_imagebuf(sdr, ('R', 'G', 'B'))
 
     # Process depth if it exists
-    depth_path = input_dir / "input_depth_0.tiff"
-    if depth_path.exists():
+    depth = None
+    if depth_image is not None:
         print("\nProcessing depth map...")
-        subprocess.run([
-            'oiiotool', str(depth_path),
-            '--ch', 'Y',
-            '--chnames', 'depth.Y',
-            '--resize', f"{width}x{height}",
-            '-o', str(input_dir / "depth.exr")
-        ], check=True)
+        depth = _to_imagebuf(depth_image, ('depth.Y',))
+        depth = _resize_to(depth, width, height)
         print("Depth map processed")
     else:
         print("\nNo depth map found")
 
     # Process mattes
     print("\nProcessing mattes...")
-    for matte in input_dir.glob("input_*matte_*.tiff"):
-        if matte.exists():
-            clean_name = matte.stem.replace("input_", "").replace("matte_", "")
-            print(f"Processing matte: {clean_name}")
-            subprocess.run([
-                'oiiotool', str(matte),
-                '--ch', 'Y',
-                '--chnames', f"mattes.{clean_name}.Y",
-                '--resize', f"{width}x{height}",
-                '-o', str(input_dir / f"{clean_name}.exr")
-            ], check=True)
-            print(f"Matte {clean_name} processed")
-    else:
+    mattes = []
+    for clean_name, matte_array in matte_images:
+        print(f"Processing matte: {clean_name}")
+        matte_image = _to_imagebuf(matte_array, (f"mattes.{clean_name}.Y",))
+        mattes.append((clean_name, _resize_to(matte_image, width, height)))
+        print(f"Matte {clean_name} processed")
+    if not mattes:
         print("No mattes found")
 
-    # Create final EXR with HDR as main RGB
+    # Create final EXR with HDR as main RGB, appending every layer in memory
     print("\nCreating final EXR...")
-    subprocess.run([
-        'oiiotool', str(input_dir / "hdr_base.exr"),
-        '--ch', 'R,G,B',
-        '-o', str(input_dir / "final.exr")
-    ], check=True)
+    final = hdr_base
     print("Base layer created")
 
     # Add SDR layer
     print("Adding SDR layer...")
-    subprocess.run([
-        'oiiotool', str(input_dir / "final.exr"),
-        str(input_dir / "base.exr"),
-        '--ch', 'sdr.R,sdr.G,sdr.B',
-        '--siappend',
-        '-o', str(input_dir / "final.exr")
-    ], check=True)
+    final = _checked(ImageBufAlgo.channel_append(final, base))
     print("SDR layer added")
 
     # Add gainmap layer if it exists
-    if gain_map_path.exists():
+    if gainmap is not None:
         print("Adding gainmap layer...")
-        subprocess.run([
-            'oiiotool', str(input_dir / "final.exr"),
-            str(input_dir / "gainmap_rgb.exr"),
-            '--ch', 'gainmap.R,gainmap.G,gainmap.B',
-            '--siappend',
-            '-o', str(input_dir / "final.exr")
-        ], check=True)
+        final = _checked(ImageBufAlgo.channel_append(final, gainmap))
         print("Gainmap layer added")
 
     # Add depth layer if it exists
-    if depth_path.exists():
+    if depth is not None:
         print("Adding depth layer...")
-        subprocess.run([
-            'oiiotool', str(input_dir / "final.exr"),
-            str(input_dir / "depth.exr"),
-            '--ch', 'depth.Y',
-            '--siappend',
-            '-o', str(input_dir / "final.exr")
-        ], check=True)
+        final = _checked(ImageBufAlgo.channel_append(final, depth))
         print("Depth layer added")
 
     # Add matte layers
     print("Adding matte layers...")
-    for matte in input_dir.glob("*.exr"):
-        if matte.stem.startswith("semantic"):
-            clean_name = matte.stem
-            print(f"Adding matte layer: {clean_name}")
-            subprocess.run([
-                'oiiotool', str(input_dir / "final.exr"),
-                str(matte),
-                '--ch', f"mattes.{clean_name}.Y",
-                '--siappend',
-                '-o', str(input_dir / "final.exr")
-            ], check=True)
-            print(f"Matte layer {clean_name} added")
+    for clean_name, matte_image in mattes:
+        print(f"Adding matte layer: {clean_name}")
+        final = _checked(ImageBufAlgo.channel_append(final, matte_image))
+        print(f"Matte layer {clean_name} added")
+
+    final_path = input_dir / "final.exr"
+    if not final.write(str(final_path), oiio.HALF):
+        raise RuntimeError(f"Could not write {final_path}: {final.geterror()}")
 
     # Move to final destination
     print(f"\nMoving final EXR to {output_path}")
-    shutil.move(str(input_dir / "final.exr"), str(output_path))
+    shutil.move(str(final_path), str(output_path))
     print("Done!")
 
 def main():
@@ -306,16 +300,16 @@ def main():
     # Create output path next to input file
     output_path = input_path.parent / f"{input_path.stem}_acesCG.exr"
 
-    # Create temporary directory
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Create temporary directory next to the output so the final move is a rename
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as temp_dir:
         temp_dir = Path(temp_dir)
         print(f"Using temporary directory: {temp_dir}")
         
         # Extract images from HEIC
-        base_path, gain_map_path, depth_path, matte_paths, headroom = extract_heic(input_path, temp_dir)
+        base, gain_map, depth, mattes, headroom = extract_heic(input_path)
         
         # Merge to EXR
-        merge_to_exr(temp_dir, input_path, output_path)
+        merge_to_exr(temp_dir, base, gain_map, depth, mattes, headroom, output_path)
 
     print(f"\nSuccessfully created: {output_path}")
 
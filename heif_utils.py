@@ -0,0 +1,26 @@
+"""Helpers shared by gain_map_extract.py and heic_to_exr.py."""
+
+import os
+import numpy as np
+import pillow_heif
+
+# HEVC decode dominates runtime, let libheif use every core. Set here so any
+# script importing these helpers gets the same decoder configuration
+pillow_heif.options.DECODE_THREADS = max(1, os.cpu_count() or 1)
+
+# 8-bit interleaved modes as_array can view, and their channel counts
+_MODE_CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+def as_array(heif_image):
+    """View decoded HEIF pixels as an (H, W) or (H, W, C) uint8 array without copying."""
+    mode = heif_image.mode
+    if mode not in _MODE_CHANNELS:
+        raise ValueError(f"Unsupported HEIF image mode {mode!r}, expected one of {tuple(_MODE_CHANNELS)}")
+    width, height = heif_image.size
+    channels = _MODE_CHANNELS[mode]
+    if channels == 1:
+        shape, strides = (height, width), (heif_image.stride, 1)
+    else:
+        shape, strides = (height, width, channels), (heif_image.stride, channels, 1)
+    # np.ndarray checks the view fits inside the decoded buffer
+    return np.ndarray(shape, np.uint8, buffer=heif_image.data, strides=strides)
@@ -9,14 +9,15 @@ input_folder="$1"
 original_heic="$2"
 output_path="${3:-output_acesCG.exr}"
 
-# Create a temporary directory for intermediate files
-temp_dir=$(mktemp -d)
+# Create a temporary directory for intermediate files next to the output,
+# so the final mv is a rename rather than a copy across filesystems
+temp_dir=$(mktemp -d "$(dirname "$output_path")/merge_to_exr.XXXXXX")
+trap 'rm -rf "$temp_dir"' EXIT
 echo "Using temporary directory: $temp_dir"
 
-# Get dimensions from base image
-base_info=$(oiiotool --info "$input_folder/input_base.tiff" | head -n1)
-width=$(echo "$base_info" | cut -d' ' -f3)
-height=$(echo "$base_info" | cut -d' ' -f5 | tr -d ',')
+# Get dimensions from base image, asking oiiotool for the spec fields directly
+base_info=$(oiiotool "$input_folder/input_base.tiff" --echo "{TOP.width} {TOP.height}")
+read -r width height <<< "$base_info"
 
 if [ -z "$width" ] || [ -z "$height" ]; then
     echo "Error: Could not determine image dimensions"
@@ -37,33 +38,66 @@ echo "Extracted HDR headroom: $headroom"
 echo "Input files found:"
 ls -1 "$input_folder"/*.tiff
 
+# The per-image conversions below are independent, so run them as background
+# jobs and wait for all of them before combining. Each oiiotool runs its own
+# thread pool, so at most one job per core is started at a time
+max_jobs=$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 4)
+pids=()
+failed=0
+
+# Wait for every running job, recording whether any of them failed, so no
+# oiiotool is left writing into $temp_dir while the EXIT trap removes it
+wait_jobs() {
+    for pid in "${pids[@]}"; do
+        wait "$pid" || failed=1
+    done
+    pids=()
+    if [ "$failed" -ne 0 ]; then
+        echo "Error: one or more oiiotool conversions failed"
+        exit 1
+    fi
+}
+
+# Drain the running jobs once max_jobs are in flight
+throttle() {
+    if [ "${#pids[@]}" -ge "$max_jobs" ]; then
+        wait_jobs
+    fi
+}
+
 # Process base image (RGB) - Convert from sRGB curve through Linear P3 to ACEScg
 echo "Processing base image..."
+throttle
 oiiotool "$input_folder/input_base.tiff" \
     --ch R,G,B \
     --chnames sdr.R,sdr.G,sdr.B \
     --colorconfig studio-config-v1.0.0_aces-v1.3_ocio-v2.1.ocio \
     --colorconvert "sRGB - Texture" "Linear Rec.709 (sRGB)" \
     --colorconvert "Linear P3-D65" "ACES - ACEScg" \
-    -o "$temp_dir/base.exr" || exit 1
+    -o "$temp_dir/base.exr" &
+pids+=($!)
 
 # Process gain map (Y) - Convert from Rec709 curve to Linear
 echo "Processing gain map..."
+throttle
 oiiotool "$input_folder/input_hdrgainmap_50.tiff" \
     --ch Y \
     --chnames gainmap.Y \
     --resize "${width}x${height}" \
     --colorconfig studio-config-v1.0.0_aces-v1.3_ocio-v2.1.ocio \
     --ocionamedtransform "Rec.709 - Curve" \
-    -o "$temp_dir/gainmap.exr" || exit 1
+    -o "$temp_dir/gainmap.exr" &
+pids+=($!)
 
 # Process depth (Y)
 echo "Processing depth map..."
+throttle
 oiiotool "$input_folder/input_depth_0.tiff" \
     --ch Y \
     --chnames depth.Y \
     --resize "${width}x${height}" \
-    -o "$temp_dir/depth.exr" || exit 1
+    -o "$temp_dir/depth.exr" &
+pids+=($!)
 
 # Process all mattes (Y)
 echo "Processing mattes..."
@@ -73,16 +107,20 @@ for matte in "$input_folder"/input_*matte_*.tiff; do
         # Clean up the matte name to be more Nuke-friendly
         clean_name=$(echo "$name" | sed 's/input_//' | sed 's/matte_//')
         echo "Processing matte: $clean_name"
+        throttle
         oiiotool "$matte" \
             --ch Y \
             --chnames "mattes.$clean_name.Y" \
             --resize "${width}x${height}" \
-            -o "$temp_dir/$clean_name.exr" || exit 1
+            -o "$temp_dir/$clean_name.exr" &
+        pids+=($!)
     else
         echo "Warning: No matte files found matching pattern: $matte"
     fi
 done
 
+wait_jobs
+
 # Apply HDR formula: hdr_rgb = sdr_rgb * (1.0 + (headroom - 1.0) * gainmap)
 echo "Applying HDR formula..."
 # Create 3-channel gainmap by duplicating Y to RGB
@@ -91,15 +129,12 @@ oiiotool "$temp_dir/gainmap.exr" \
     --chnames R,G,B \
     -o "$temp_dir/gainmap_rgb.exr" || exit 1
 
-# Calculate HDR: first multiply gainmap by (headroom - 1.0)
-oiiotool "$temp_dir/gainmap_rgb.exr" \
+# Calculate HDR in one invocation: scale gainmap by (headroom - 1.0), add 1.0,
+# then multiply base image by it, keeping the scaled gainmap in memory
+oiiotool "$temp_dir/base.exr" \
+    "$temp_dir/gainmap_rgb.exr" \
     --mulc "$(echo "$headroom - 1.0" | bc -l)" \
     --addc 1.0 \
-    -o "$temp_dir/gainmap_scaled.exr" || exit 1
-
-# Then multiply base image by scaled gainmap
-oiiotool "$temp_dir/base.exr" \
-    "$temp_dir/gainmap_scaled.exr" \
     --mul \
     --chnames R,G,B \
     -o "$temp_dir/hdr_base.exr" || exit 1
@@ -107,45 +142,30 @@ oiiotool "$temp_dir/base.exr" \
 # Create final EXR
 echo "Creating final multilayer EXR..."
 
+# Build a single oiiotool command so every layer is appended in memory
 # First, create with HDR as main RGB
-oiiotool "$temp_dir/hdr_base.exr" \
-    --ch R,G,B \
-    -o "$temp_dir/final.exr" || exit 1
+final_args=("$temp_dir/hdr_base.exr" --ch R,G,B)
 
 # Add SDR layer
-oiiotool "$temp_dir/final.exr" "$temp_dir/base.exr" \
-    --ch sdr.R,sdr.G,sdr.B \
-    --siappend \
-    -o "$temp_dir/final.exr" || exit 1
+final_args+=("$temp_dir/base.exr" --ch sdr.R,sdr.G,sdr.B --siappend)
 
 # Add gainmap layer (using the RGB version we created earlier)
-oiiotool "$temp_dir/final.exr" "$temp_dir/gainmap_rgb.exr" \
-    --ch R,G,B \
-    --chnames gainmap.R,gainmap.G,gainmap.B \
-    --siappend \
-    -o "$temp_dir/final.exr" || exit 1
+final_args+=("$temp_dir/gainmap_rgb.exr" --ch R,G,B --chnames gainmap.R,gainmap.G,gainmap.B --siappend)
 
 # Add depth layer
-oiiotool "$temp_dir/final.exr" "$temp_dir/depth.exr" \
-    --ch depth.Y \
-    --siappend \
-    -o "$temp_dir/final.exr" || exit 1
+final_args+=("$temp_dir/depth.exr" --ch depth.Y --siappend)
 
 # Add matte layers
 for m in "$temp_dir"/semantic*.exr; do
     if [ -f "$m" ]; then
         clean_name=$(basename "$m" .exr)
-        oiiotool "$temp_dir/final.exr" "$m" \
-            --ch "mattes.$clean_name.Y" \
-            --siappend \
-            -o "$temp_dir/final.exr" || exit 1
+        final_args+=("$m" --ch "mattes.$clean_name.Y" --siappend)
     fi
 done
 
+oiiotool "${final_args[@]}" -o "$temp_dir/final.exr" || exit 1
+
 # Move to final destination
 mv "$temp_dir/final.exr" "$output_path"
 
-# Clean up temporary files
-rm -rf "$temp_dir"
-
 echo "Successfully merged TIFFs into: $output_path" 
\ No newline at end of file